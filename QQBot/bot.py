@@ -1,18 +1,39 @@
+import asyncio
+import atexit
+import multiprocessing
 import re
+import time
 
 import nonebot
 from nonebot.adapters.onebot.v11 import Adapter as V11_Adapter
 from nonebot.adapters.onebot.v11 import MessageEvent as V11_MessageEvent
+from nonebot.adapters.onebot.v11 import MessageSegment as V11_MessageSegment
 from nonebot.log import logger
 from nonebot.typing import T_State
 
 from chatgpt import ChatGPT
 from config import BotConfig
 from dialog_manager import DialogManager
+from log_sink import QueuedLogSink, exclude_verbose_from_console, verbose_logger
+from text_render import TextRenderer
 from utils import cooldown_checker, create_matcher
 
-logger.add("bot.log")
-logger.level("INFO")
+config = BotConfig.from_config("config.json")
+
+verbose_logger.sample_rate = config.log_verbose_sample_rate
+exclude_verbose_from_console()
+# Spawned render workers re-import this module as `__mp_main__`, only the main process may own bot.log
+if multiprocessing.parent_process() is None:
+    log_sink = QueuedLogSink(
+        config.log_file,
+        queue_size=config.log_queue_size,
+        max_payload=config.log_max_payload,
+        max_bytes=config.log_max_bytes,
+        backup_count=config.log_backup_count,
+        structured=config.log_structured,
+    )
+    # Closed at exit rather than in a shutdown hook, so that nonebot's own shutdown messages are kept
+    atexit.register(log_sink.close)
 
 nonebot.init(host="127.0.0.1", port=8080)
 nonebot.load_from_toml("pyproject.toml")
@@ -20,8 +41,6 @@ nonebot.load_from_toml("pyproject.toml")
 driver = nonebot.get_driver()
 driver.register_adapter(V11_Adapter)
 
-config = BotConfig.from_config("config.json")
-
 # ChatGPT & Dialog manager
 bot = ChatGPT(config.api_key)
 dialog_manager = DialogManager(
@@ -29,6 +48,58 @@ dialog_manager = DialogManager(
     dialog_max_length=config.dialog_max_length,
     default_personality=config.default_personality,
 )
+text_renderer = None
+if config.response_image:
+    try:
+        text_renderer = TextRenderer(
+            config.response_image_cache_dir,
+            font_path=config.response_image_font,
+            cache_size=config.response_image_cache_size,
+        )
+    except Exception as e:
+        # Image replies are optional, fall back to text instead of refusing to start
+        logger.error(f"回复图片模式初始化失败，将以文字回复：{e}")
+
+
+_warm_up_task = None
+
+
+def _time_since_process_start() -> float:
+    import psutil
+
+    return time.time() - psutil.Process().create_time()
+
+
+@driver.on_startup
+async def _warm_up():
+    """
+    Restore dialog states, warm up the tokenizer and read the templates in parallel. Only the restore
+    has to finish before any message is handled, the warm-up continues in the background.
+    """
+    loop = asyncio.get_running_loop()
+    restore = loop.run_in_executor(None, dialog_manager.load_all_state)
+
+    async def _run():
+        try:
+            await asyncio.gather(
+                restore,
+                loop.run_in_executor(None, bot.warm_up),
+                loop.run_in_executor(None, dialog_manager.warm_up_personalities),
+            )
+        except Exception:
+            logger.exception(f"预热失败，耗时{_time_since_process_start():.2f}秒，将在首次请求时加载")
+        else:
+            logger.info(f"启动完成，耗时{_time_since_process_start():.2f}秒")
+
+    global _warm_up_task
+    _warm_up_task = asyncio.create_task(_run())
+    await restore
+
+
+@driver.on_shutdown
+async def _shutdown_text_renderer():
+    if text_renderer is not None:
+        text_renderer.shutdown()
 
 # Matchers
 help_matcher = create_matcher(command=["h", "help"], priority=1)
@@ -88,7 +159,7 @@ async def _refresh_matcher(event: V11_MessageEvent, state: T_State):
 
 @rollback_matcher.handle()
 async def _rollback_matcher(event: V11_MessageEvent, state: T_State):
-    logger.info(str(event.__dict__))
+    verbose_logger.info("[rollback] {}: {}", event.get_user_id(), event.raw_message)
 
     user_id = event.get_user_id()
     message = event.get_message()
@@ -127,7 +198,9 @@ async def _chat_matcher(event: V11_MessageEvent, state: T_State):
                                               secret_keys=config.web_api_secret_keys)
     else:
         response = await bot.interact_chatgpt_with_plugins(dialog_manager[user_id]["dialog"],
-                                                           secret_keys=config.web_api_secret_keys)
+                                                           secret_keys=config.web_api_secret_keys,
+                                                           plugin_deadline=config.plugin_deadline,
+                                                           plugin_hedge_delay=config.plugin_hedge_delay)
 
     if response is None:
         logger.error("[超时]")
@@ -141,9 +214,20 @@ async def _chat_matcher(event: V11_MessageEvent, state: T_State):
 
     else:
         response["content"] = response["content"].strip()
-        logger.info(f"[回复]：{response['content']}")
+        verbose_logger.info("[回复]：{}", response["content"])
         dialog_manager.add_content(user_id, **response)
-        await chat_matcher.send(response["content"], at_sender=True)
+        await chat_matcher.send(await _format_reply(response["content"]), at_sender=True)
+
+
+async def _format_reply(content: str):
+    """ Long replies are sent as an image when `response_image` is enabled. """
+    if text_renderer is None or len(content) < config.response_image_threshold:
+        return content
+    try:
+        return V11_MessageSegment.image(await text_renderer.render(content))
+    except Exception as e:
+        logger.error(f"回复图片渲染失败：{e}")
+        return content
 
 
 if __name__ == "__main__":
@@ -6,27 +6,73 @@
 @Version     :  1.0
 @Description :  None
 """
+import asyncio
 import concurrent.futures
 import datetime
 import json
-import multiprocessing
 import re
+import threading
+import time
 from dataclasses import dataclass
+from functools import lru_cache, partial
 from typing import List, Optional, Tuple
 
 import openai
-import tiktoken
 from nonebot.log import logger
 
-from web_api import query_web_api
+from log_sink import verbose_logger
+from utils import read_template
+from web_api import REGISTERED_API, call_web_api
+
+_PLUGIN_TEMPLATES = [
+    "personality/plugin/2_generate_plugin_calls.txt",
+    "personality/plugin/3_generate_reply.txt",
+]
+
+# Shared by all plugin turns. Plugin calls wait on the network, so the pool is sized for I/O, not CPUs.
+_PLUGIN_MAX_WORKERS = 32
+_PLUGIN_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=_PLUGIN_MAX_WORKERS, thread_name_prefix="plugin_api",
+)
+_plugin_lock = threading.Lock()
+_plugin_in_flight = 0
+
+
+def _release_plugin_worker(_future: concurrent.futures.Future):
+    global _plugin_in_flight
+    with _plugin_lock:
+        _plugin_in_flight -= 1
+
+
+def _submit_plugin_call(limit: int, *args, **kwargs) -> Optional[concurrent.futures.Future]:
+    """
+    Submit a plugin call only if fewer than `limit` calls are running, so that a call never sits in the
+    executor queue behind hung ones. Returns None when the pool is saturated.
+    """
+    global _plugin_in_flight
+    with _plugin_lock:
+        if _plugin_in_flight >= limit:
+            return None
+        _plugin_in_flight += 1
+    future = _PLUGIN_EXECUTOR.submit(call_web_api, *args, **kwargs)
+    future.add_done_callback(_release_plugin_worker)
+    return future
 
 
-def num_tokens_from_messages(messages: List[dict], model="gpt-3.5-turbo-0301") -> int:
-    """Returns the number of tokens used by a list of messages."""
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """ Loading an encoding is slow, so import `tiktoken` lazily and load each encoding only once. """
+    import tiktoken
+
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_messages(messages: List[dict], model="gpt-3.5-turbo-0301") -> int:
+    """Returns the number of tokens used by a list of messages."""
+    encoding = _get_encoding(model)
     if model == "gpt-3.5-turbo-0301":  # note: future models may deviate from this
         num_tokens = 0
         for message in messages:
@@ -58,6 +104,13 @@ class ChatGPT:
     def __init__(self, api_key: str):
         openai.api_key = api_key
 
+    @staticmethod
+    def warm_up(model: str = "gpt-3.5-turbo-0301"):
+        """ Load the tokenizer and plugin templates ahead of the first request. """
+        _get_encoding(model)
+        for template_file in _PLUGIN_TEMPLATES:
+            read_template(template_file)
+
     @staticmethod
     def _auto_retry_completion(completion_args: dict, timeout=30, timeout_retry=1) -> Optional[List[dict]]:
         """ `completion_args` should contain at least `message` """
@@ -113,9 +166,18 @@ class ChatGPT:
         return "\n".join(f"{m['role']}:{m['content']}" for m in messages)
 
     @staticmethod
-    def _call_plugin_apis(plugin_APIs: List[dict], secret_keys: dict = None) -> List[str]:
+    def _call_plugin_apis(
+            plugin_APIs: List[dict], secret_keys: dict = None,
+            deadline: float = 10.0, hedge_delay: Optional[float] = None,
+    ) -> List[str]:
+        """
+        Call plugin APIs concurrently. Results arriving within `deadline` seconds are used and the rest
+        are dropped. If `hedge_delay` is set, a duplicate request is sent for calls still pending after
+        `hedge_delay` seconds, and whichever copy returns first wins.
+        """
         search_results: List[str] = []
         queries: List[Tuple[str, str]] = []
+        secret_keys = {} if secret_keys is None else secret_keys
 
         for API in plugin_APIs:
             try:
@@ -124,20 +186,91 @@ class ChatGPT:
                 logger.warning(f"不完整的API：{API}")
                 continue
             else:
-                logger.info(f"完整API：{API}")
+                verbose_logger.info("完整API：{}", API)
                 queries.append((plugin_name, query))
 
-        # 并发调用API
-        with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-            futures = [executor.submit(query_web_api, *args, **secret_keys) for args in queries]
+        if not queries:
+            return search_results
 
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                results = future.result()
-                search_results.extend(results)
-                logger.info(f"API成功返回：{results}")
-            except Exception as e:
-                logger.error(f"执行出错: {e}")
+        # 并发调用API，超过截止时间的结果直接丢弃
+        end_time = time.monotonic() + deadline
+        hedge_at = None if hedge_delay is None else time.monotonic() + hedge_delay
+        tickets = {}
+        owners = {}
+        finished = set()
+        dropped = []
+
+        for idx, (plugin_name, query) in enumerate(queries):
+            if plugin_name not in REGISTERED_API:
+                logger.error(f"执行出错: No such api_name: {plugin_name}")
+                continue
+            breaker = REGISTERED_API[plugin_name].circuit_breaker
+            ticket = breaker.allow_request()
+            if ticket is None:
+                logger.warning(f"API已熔断，跳过：{queries[idx]}")
+                dropped.append(queries[idx])
+                continue
+            future = _submit_plugin_call(_PLUGIN_MAX_WORKERS, plugin_name, query, **secret_keys)
+            if future is None:
+                breaker.cancel(ticket)
+                logger.warning(f"API线程池已满，跳过：{queries[idx]}")
+                dropped.append(queries[idx])
+                continue
+            tickets[idx] = ticket
+            owners[future] = idx
+
+        def _record(i: int, success: bool):
+            # Each query is one outcome for its breaker, however many hedged copies were sent
+            REGISTERED_API[queries[i][0]].circuit_breaker.record(
+                tickets[i], success, time.monotonic() - tickets[i].started,
+            )
+            finished.add(i)
+
+        pending = set(owners)
+        try:
+            while pending and len(finished) < len(tickets):
+                now = time.monotonic()
+                if now >= end_time:
+                    break
+                wait_until = end_time if hedge_at is None else min(end_time, hedge_at)
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=wait_until - now, return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+
+                for future in done:
+                    idx = owners[future]
+                    if idx in finished:
+                        continue
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        logger.error(f"执行出错: {e}")
+                        if not any(owners[f] == idx for f in pending):
+                            _record(idx, False)
+                        continue
+                    _record(idx, True)
+                    search_results.extend(results)
+                    verbose_logger.info("API成功返回：{}", results)
+
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    for idx in {owners[f] for f in pending} - finished:
+                        # Hedged copies may only use half of the pool, so they cannot starve first attempts
+                        future = _submit_plugin_call(_PLUGIN_MAX_WORKERS // 2, *queries[idx], **secret_keys)
+                        if future is None:
+                            break
+                        logger.info(f"API响应过慢，发送对冲请求：{queries[idx]}")
+                        owners[future] = idx
+                        pending.add(future)
+        finally:
+            for future in pending:
+                future.cancel()
+
+        for idx in set(tickets) - finished:
+            _record(idx, False)
+            dropped.append(queries[idx])
+        if dropped:
+            logger.warning(f"API超过截止时间或被跳过，结果已丢弃：{dropped}")
 
         # for API in plugin_APIs:
         #     try:
@@ -156,6 +289,7 @@ class ChatGPT:
     async def interact_chatgpt_with_plugins(
             messages: List[dict], chat_completion_args: ChatCompletionArgs = _DEFAULT_ARGS,
             timeout=20, timeout_retry=2, secret_keys: dict = None,
+            plugin_deadline: float = 10.0, plugin_hedge_delay: Optional[float] = None,
     ) -> Optional[dict]:
         """ Enable the large model to access external knowledge and tools. """
         logger.info("`interact_chatgpt_with_plugins`被调用")
@@ -165,10 +299,9 @@ class ChatGPT:
         date_and_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
 
         ### 0x01: Generate plugin calls
-        with open("personality/plugin/2_generate_plugin_calls.txt", encoding="utf8") as f:
-            plugin_prompt = f.read()
-            plugin_prompt = plugin_prompt.replace("{{dialog_history}}", summarized_dialog)
-            plugin_prompt = plugin_prompt.replace("{{date_and_time}}", date_and_time)
+        plugin_prompt = read_template("personality/plugin/2_generate_plugin_calls.txt")
+        plugin_prompt = plugin_prompt.replace("{{dialog_history}}", summarized_dialog)
+        plugin_prompt = plugin_prompt.replace("{{date_and_time}}", date_and_time)
 
         response = ChatGPT._auto_retry_completion(
             completion_args={"messages": [{"role": "user", "content": plugin_prompt}], **vars(chat_completion_args)},
@@ -184,20 +317,22 @@ class ChatGPT:
             APIs_str = response_message["content"].strip()
             APIs_str = re.search(r"\[.*]", APIs_str).group()
             APIs: List[dict] = json.loads(APIs_str)
-            logger.info(f"[API] {APIs}")
+            verbose_logger.info("[API] {}", APIs)
         except (json.JSONDecodeError, KeyError, AttributeError):
             # Normal reply or abnormal result is returned directly
             return response_message
 
-        ### 0x02: Call APIs sequentially
-        search_results = ChatGPT._call_plugin_apis(APIs, secret_keys)
+        ### 0x02: Call APIs concurrently within the deadline
+        search_results = await asyncio.get_running_loop().run_in_executor(
+            None, partial(ChatGPT._call_plugin_apis, APIs, secret_keys,
+                          deadline=plugin_deadline, hedge_delay=plugin_hedge_delay),
+        )
 
         ### 0x03. Generate reply based on the dialog history and the results of plugins
-        with open("personality/plugin/3_generate_reply.txt", encoding="utf8") as f:
-            reply_prompt = f.read()
-            reply_prompt = reply_prompt.replace("{{dialog_history}}", summarized_dialog)
-            reply_prompt = reply_prompt.replace("{{knowledge}}", "\n".join(search_results))
-            reply_prompt = reply_prompt.replace("{{date_and_time}}", date_and_time)
+        reply_prompt = read_template("personality/plugin/3_generate_reply.txt")
+        reply_prompt = reply_prompt.replace("{{dialog_history}}", summarized_dialog)
+        reply_prompt = reply_prompt.replace("{{knowledge}}", "\n".join(search_results))
+        reply_prompt = reply_prompt.replace("{{date_and_time}}", date_and_time)
 
         response2 = ChatGPT._auto_retry_completion(
             completion_args={"messages": [{"role": "user", "content": reply_prompt}], **vars(chat_completion_args)},
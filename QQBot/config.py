@@ -8,6 +8,7 @@
 """
 import json
 from dataclasses import dataclass, field
+from typing import Optional
 
 
 @dataclass
@@ -15,6 +16,10 @@ class BotConfig:
     dialog_command: str = field(default="")
     cd_time: int = field(default=3)
     response_image: bool = field(default=False)
+    response_image_threshold: int = field(default=500)
+    response_image_font: Optional[str] = field(default=None)
+    response_image_cache_dir: str = field(default="./image_cache")
+    response_image_cache_size: int = field(default=1000)
 
     api_key: str = field(default=None)
     default_personality: str = field(default="chatgpt")
@@ -24,6 +29,16 @@ class BotConfig:
     web_api_secret_keys: dict = field(
         default_factory=lambda: {"wolfram_appid": "", "google_key": "", "google_cx": ""}
     )
+    plugin_deadline: float = field(default=10.0)
+    plugin_hedge_delay: Optional[float] = field(default=None)
+
+    log_file: str = field(default="bot.log")
+    log_structured: bool = field(default=False)
+    log_queue_size: int = field(default=10000)
+    log_max_payload: int = field(default=2000)
+    log_verbose_sample_rate: float = field(default=1.0)
+    log_max_bytes: int = field(default=10 * 1024 * 1024)
+    log_backup_count: int = field(default=5)
 
     @classmethod
     def from_config(cls, config_file: str):
@@ -15,6 +15,8 @@ from typing import List, Optional
 from nonebot.log import logger
 
 from chatgpt import num_tokens_from_messages
+from log_sink import verbose_logger
+from utils import read_template
 
 
 class DialogManager(defaultdict):
@@ -33,14 +35,15 @@ class DialogManager(defaultdict):
         self.dialog_max_length = dialog_max_length
 
         os.makedirs(save_dir, exist_ok=True)
-        self._load_all_state()
 
-    def _load_all_state(self):
-        for file in sorted(glob.glob(os.path.join(self.save_dir, "*.json"))):
+    def load_all_state(self):
+        """ Restore saved dialogs, called from the startup hook rather than at import time. """
+        files = sorted(glob.glob(os.path.join(self.save_dir, "*.json")))
+        for file in files:
             user_id = os.path.split(file)[-1][:-5]
             with open(file, encoding="utf8") as f:
                 self[user_id] = json.load(f)
-            logger.info(f"恢复与{user_id}的{len(self[user_id]['dialog'])}条对话")
+        logger.info(f"恢复{len(files)}个用户的对话，共{sum(len(v['dialog']) for v in self.values())}条")
 
     def _dump_state(self, user_id: str):
         # Easy implement :)
@@ -62,6 +65,12 @@ class DialogManager(defaultdict):
         personality_files = glob.glob(os.path.join("./personality", "*"))
         return [os.path.split(file)[-1] for file in personality_files]
 
+    def warm_up_personalities(self):
+        """ Read all personality templates ahead of the first `checkout_personality`. """
+        for personality in self.show_available_personalities():
+            if not os.path.isdir(p_file := os.path.join("personality", personality)):
+                read_template(p_file)
+
     def checkout_personality(self, user_id: str, personality: str = None):
         """
         :param user_id:         User ID
@@ -77,8 +86,7 @@ class DialogManager(defaultdict):
 
             if (p_file := os.path.join("personality", f"{personality}")) and not os.path.isdir(p_file):
                 # Plugin personality will clear current system prompt
-                with open(p_file, encoding="utf8") as f:
-                    personality_info: dict = {"role": "system", "content": f.read()}
+                personality_info: dict = {"role": "system", "content": read_template(p_file)}
 
                 current_user["dialog"].insert(0, personality_info)
 
@@ -109,7 +117,7 @@ class DialogManager(defaultdict):
                 target_role = "user"
             else:
                 popped_content = current_user["dialog"].pop(idx)
-                logger.warning(f"Length overflow ==> pop {popped_content}")
+                verbose_logger.warning("Length overflow ==> pop {}", popped_content)
 
         self._dump_state(user_id)
 
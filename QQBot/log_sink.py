@@ -0,0 +1,143 @@
+"""
+@File        :  log_sink
+@Contact     :  dlf43@qq.com
+@Author      :  Randool
+@Create Time :  2023/4/15
+@Version     :  1.0
+@Description :  Loguru sink that formats and writes records off the event loop.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import traceback
+from typing import Optional
+
+from nonebot.log import default_filter, default_format, logger, logger_id
+
+_STOP = object()
+
+
+class VerboseLogger:
+    """
+    Logger for verbose records (prompts, API results, ...). Records are sampled before loguru formats
+    them, so pass payloads as arguments (`verbose_logger.info("[API] {}", APIs)`) rather than f-strings
+    and a dropped record costs nothing but a `random.random()`.
+    """
+
+    def __init__(self, sample_rate: float = 1.0):
+        self.sample_rate = sample_rate
+        # depth=2 reports the caller of `info`/`warning` instead of `_log`
+        self._logger = logger.bind(verbose=True).opt(depth=2)
+
+    def _log(self, level: str, message: str, *args):
+        if random.random() < self.sample_rate:
+            self._logger.log(level, message, *args)
+
+    def info(self, message: str, *args):
+        self._log("INFO", message, *args)
+
+    def warning(self, message: str, *args):
+        self._log("WARNING", message, *args)
+
+
+verbose_logger = VerboseLogger()
+
+
+def exclude_verbose_from_console() -> int:
+    """ Replace nonebot's synchronous console handler with one that skips verbose records. """
+    logger.remove(logger_id)
+    return logger.add(
+        sys.stdout, level=0, diagnose=False, format=default_format,
+        filter=lambda record: not record["extra"].get("verbose") and default_filter(record),
+    )
+
+
+class QueuedLogSink:
+    """
+    The emitting thread only truncates and enqueues a record. Formatting, file I/O and rotation are
+    done by a background thread. When the bounded queue is full, records are dropped and the number
+    of dropped records is reported later.
+    """
+
+    def __init__(self, log_file: str, level: str = "INFO", queue_size: int = 10000, max_payload: int = 2000,
+                 max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5, structured: bool = False):
+        self.max_payload = max_payload
+        self.structured = structured
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf8",
+        )
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        self._thread = threading.Thread(target=self._run, name="QueuedLogSink", daemon=True)
+        self._thread.start()
+
+        self.handler_id = logger.add(self, level=level, format="{message}")
+
+    def __call__(self, message):
+        record = message.record
+        text = record["message"]
+        if len(text) > self.max_payload:
+            text = f"{text[:self.max_payload]}...[truncated {len(text) - self.max_payload} chars]"
+
+        item = (record["time"], record["level"].name, record["name"], record["function"], record["line"],
+                text, record["exception"])
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # Plugin worker threads log through this sink as well
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def _format(self, item) -> str:
+        time, level, name, function, line, text, exception = item
+        if self.structured:
+            data = {
+                "time": time.isoformat(), "level": level, "location": f"{name}:{function}:{line}", "message": text,
+            }
+            if exception is not None:
+                data["exception"] = "".join(traceback.format_exception(*exception))
+            return json.dumps(data, ensure_ascii=False)
+
+        formatted = f"{time:%Y-%m-%d %H:%M:%S.%f}"[:-3] + f" | {level:<8} | {name}:{function}:{line} - {text}"
+        if exception is not None:
+            formatted += "\n" + "".join(traceback.format_exception(*exception)).rstrip()
+        return formatted
+
+    def _emit(self, formatted: str):
+        self._handler.emit(logging.makeLogRecord({"msg": formatted, "levelno": logging.INFO}))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            self._report_dropped()
+            if item is _STOP:
+                break
+
+            try:
+                self._emit(self._format(item))
+            except Exception:
+                traceback.print_exc()
+
+        self._handler.close()
+
+    def _report_dropped(self):
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            self._emit(f"[QueuedLogSink] 日志队列已满，丢弃{dropped}条记录")
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """ Unregister from loguru, flush the queued records and stop the writer thread. """
+        logger.remove(self.handler_id)
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
@@ -0,0 +1,182 @@
+"""
+@File        :  text_render
+@Contact     :  dlf43@qq.com
+@Author      :  Randool
+@Create Time :  2023/4/12
+@Version     :  1.0
+@Description :  Render long replies into PNG images in a process pool.
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+from typing import List, Optional
+
+from nonebot.log import logger
+
+_PADDING = 20
+_LINE_SPACING = 6
+_BACKGROUND = (255, 255, 255)
+_FOREGROUND = (0, 0, 0)
+
+# Replies are mostly Chinese, so a TrueType font with CJK glyphs is required. These common locations are
+# tried when `font_path` is not configured.
+_CJK_FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+]
+
+
+def _wrap_lines(text: str, font, max_width: int) -> List[str]:
+    """ Wrap by pixel width so that CJK and ASCII text both fit the canvas. """
+    widths = {}
+    lines = []
+    for raw_line in text.expandtabs(4).splitlines() or [""]:
+        line, line_width = "", 0.0
+        for char in raw_line:
+            # Measure each distinct character once and keep a running total, so wrapping stays linear
+            if char not in widths:
+                widths[char] = font.getlength(char)
+            if line and line_width + widths[char] > max_width:
+                lines.append(line)
+                line, line_width = "", 0.0
+            line += char
+            line_width += widths[char]
+        lines.append(line)
+    return lines
+
+
+def _find_cjk_font() -> Optional[str]:
+    for font_path in _CJK_FONT_CANDIDATES:
+        if os.path.isfile(font_path):
+            return font_path
+    return None
+
+
+def _render_png(text: str, font_path: str, font_size: int, max_width: int) -> bytes:
+    """ Runs in a worker process, so rendering never blocks the event loop. """
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.truetype(font_path, font_size)
+
+    lines = _wrap_lines(text, font, max_width)
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent + _LINE_SPACING
+    width = int(max(font.getlength(line) for line in lines)) + 2 * _PADDING
+    height = line_height * len(lines) + 2 * _PADDING
+
+    image = Image.new("RGB", (width, height), _BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((_PADDING, _PADDING + i * line_height), line, font=font, fill=_FOREGROUND)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+class TextRenderer:
+    """
+    Render text to PNG off the event loop. Images are cached on disk by content hash, and the least
+    recently used images are evicted once the cache holds more than `cache_size` files.
+    """
+
+    def __init__(self, cache_dir: str, font_path: Optional[str] = None, font_size: int = 24,
+                 max_width: int = 1000, max_workers: int = 2, cache_size: int = 1000):
+        from PIL import ImageFont
+
+        font_path = font_path or _find_cjk_font()
+        if font_path is None:
+            raise FileNotFoundError("`response_image` needs a TrueType font with CJK glyphs, "
+                                    "set `response_image_font` to its path")
+        # Fail at startup rather than on every render if the font cannot be loaded
+        ImageFont.truetype(font_path, font_size)
+
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.font_path = font_path
+        self.font_size = font_size
+        self.max_width = max_width
+        self.max_workers = max_workers
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_file(self, text: str) -> str:
+        key = f"{self.font_path}|{self.font_size}|{self.max_width}|{text}"
+        digest = hashlib.sha256(key.encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.png")
+
+    @staticmethod
+    def _read_cache(cache_file: str) -> Optional[bytes]:
+        try:
+            with open(cache_file, "rb") as f:
+                image = f.read()
+        except FileNotFoundError:
+            return None
+        # Refresh mtime, which is used as the LRU order for eviction
+        try:
+            os.utime(cache_file)
+        except FileNotFoundError:
+            pass
+        return image
+
+    def _write_cache(self, cache_file: str, image: bytes):
+        # Write to a temporary file first so a concurrent reader never sees a partial image
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        os.replace(tmp_file, cache_file)
+
+        # Other writers evict concurrently, so any entry may disappear between `scandir` and `stat`
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".png"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        if len(entries) > self.cache_size:
+            entries.sort()
+            for _mtime, path in entries[:len(entries) - self.cache_size]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    async def render(self, text: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        cache_file = self._cache_file(text)
+
+        # Cache I/O runs in the default thread pool, rendering in the process pool
+        image = await loop.run_in_executor(None, self._read_cache, cache_file)
+        if image is not None:
+            return image
+
+        if self._executor is None:
+            # Spawn rather than fork, the log writer and plugin threads may hold locks at fork time
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        image = await loop.run_in_executor(
+            self._executor, _render_png, text, self.font_path, self.font_size, self.max_width,
+        )
+        await loop.run_in_executor(None, self._write_cache, cache_file, image)
+        logger.info(f"渲染回复图片：{cache_file}")
+
+        return image
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
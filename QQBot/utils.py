@@ -6,7 +6,9 @@
 @Version     :  1.0
 @Description :  None
 """
+import os
 from collections import defaultdict
+from functools import lru_cache
 from typing import Any, AsyncGenerator, Dict, List, Type, Union
 
 from nonebot import on_command, on_message
@@ -45,6 +47,17 @@ def create_matcher(
     return on_matcher(**params)
 
 
+@lru_cache(maxsize=128)
+def _read_template(template_file: str, mtime: float) -> str:
+    with open(template_file, encoding="utf8") as f:
+        return f.read()
+
+
+def read_template(template_file: str) -> str:
+    """ Personality and plugin prompt templates are cached until the file is modified. """
+    return _read_template(template_file, os.stat(template_file).st_mtime)
+
+
 def cooldown_checker(cd_time: int) -> Any:
     cooldown = defaultdict(int)
 
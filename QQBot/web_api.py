@@ -1,13 +1,97 @@
 import re
+import threading
+import time
 import urllib.parse
-from typing import List, Optional
-
-import openai
-import requests
-import wolframalpha
+from typing import List, NamedTuple, Optional
+
+# `requests`, `wolframalpha`, `xmltodict` and `openai` are only needed by plugins, import them lazily to speed up startup
+
+
+class CircuitTicket(NamedTuple):
+    """ Issued by `CircuitBreaker.allow_request` and handed back to `CircuitBreaker.record`. """
+    generation: int
+    probe: bool
+    started: float
+
+
+class CircuitBreaker:
+    """
+    Per-API circuit breaker. Failures and slow responses both count as errors; after
+    `failure_threshold` consecutive errors the breaker opens and rejects calls for
+    `recovery_time` seconds, then lets a single probe call through (half-open).
+
+    Only the outcome of the current probe can close or reopen the breaker. Calls that started before
+    the breaker last opened are ignored when they finish late.
+    """
+
+    def __init__(self, failure_threshold: int = 3, slow_call_time: float = 8.0, recovery_time: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.slow_call_time = slow_call_time
+        self.recovery_time = recovery_time
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # Bumped every time the breaker opens, so that late calls from before can be told apart
+        self._generation = 0
+        self._probe: Optional[CircuitTicket] = None
+
+    def allow_request(self) -> Optional[CircuitTicket]:
+        """ Returns a ticket for the call, or None if the breaker rejects it. """
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_at is None:
+                return CircuitTicket(self._generation, False, now)
+            if now - self._opened_at < self.recovery_time:
+                return None
+            # Half-open: let one probe call through, a probe that never returned expires after `recovery_time`
+            if self._probe is not None and now - self._probe.started < self.recovery_time:
+                return None
+            self._probe = CircuitTicket(self._generation, True, now)
+            return self._probe
+
+    def cancel(self, ticket: CircuitTicket):
+        """ Give back a ticket whose call was never made. """
+        with self._lock:
+            if ticket is self._probe:
+                self._probe = None
+
+    def record(self, ticket: CircuitTicket, success: bool, elapsed: float):
+        ok = success and elapsed <= self.slow_call_time
+        with self._lock:
+            if ticket.probe:
+                if ticket is not self._probe:
+                    return
+                self._probe = None
+                if ok:
+                    self._failures = 0
+                    self._opened_at = None
+                else:
+                    self._open()
+                return
+
+            if ticket.generation != self._generation or self._opened_at is not None:
+                return
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self._failures = 0
+        self._opened_at = time.monotonic()
+        self._generation += 1
+
+
+class CircuitOpenError(RuntimeError):
+    pass
 
 
 class MetaAPI:
+    circuit_breaker: CircuitBreaker
+
     @staticmethod
     def call(*args, **kwargs) -> List[str]:
         pass
@@ -18,7 +102,7 @@ class WikiSearchAPI(MetaAPI):
     base_url = 'https://en.wikipedia.org/w/api.php'
 
     @staticmethod
-    def call(query: str, num_results: int = 4, **kwargs) -> List[str]:
+    def call(query: str, num_results: int = 4, timeout: float = 10.0, **kwargs) -> List[str]:
         def remove_html_tags(text):
             return re.sub(re.compile('<.*?>'), '', text)
 
@@ -28,8 +112,10 @@ class WikiSearchAPI(MetaAPI):
             "list": "search",
             "srsearch": query,
         }
+        import requests
+
         call_url = WikiSearchAPI.base_url + urllib.parse.urlencode(params)
-        r = requests.get(call_url)
+        r = requests.get(call_url, timeout=timeout)
 
         if r.status_code != 200:
             return []
@@ -45,7 +131,8 @@ class GoogleAPI(MetaAPI):
     base_url = 'https://customsearch.googleapis.com/customsearch/v1?'
 
     @staticmethod
-    def call(query: str, google_key: str, google_cx: str, num_results: int = 3, **kwargs) -> List[str]:
+    def call(query: str, google_key: str, google_cx: str, num_results: int = 3, timeout: float = 10.0,
+             **kwargs) -> List[str]:
         params = {
             'key': google_key,
             'q': query,
@@ -54,8 +141,10 @@ class GoogleAPI(MetaAPI):
             'num': num_results
         }
 
+        import requests
+
         # call_url = GoogleAPI.base_url + urllib.parse.urlencode(params)
-        r = requests.get(GoogleAPI.base_url, params=params)
+        r = requests.get(GoogleAPI.base_url, params=params, timeout=timeout)
         if "items" in r.json():
             items = r.json()["items"]
             filter_data = [
@@ -72,9 +161,15 @@ class WolframAPI(MetaAPI):
     base_url = 'https://api.wolframalpha.com/v2/query'
 
     @staticmethod
-    def call(query: str, wolfram_appid: str, num_results: int = 5, **kwargs) -> List[str]:
-        client = wolframalpha.Client(app_id=wolfram_appid)
-        response = client.query(query)
+    def call(query: str, wolfram_appid: str, num_results: int = 5, timeout: float = 10.0, **kwargs) -> List[str]:
+        import requests
+        import wolframalpha
+        import xmltodict
+
+        # `wolframalpha.Client.query` has no timeout, so send the request ourselves and reuse its result parser
+        r = requests.get(WolframAPI.base_url, params={"input": query, "appid": wolfram_appid}, timeout=timeout)
+        r.raise_for_status()
+        response = xmltodict.parse(r.content, postprocessor=wolframalpha.Document.make)["queryresult"]
         # print(response)
         results = []
 
@@ -90,52 +185,37 @@ class WolframAPI(MetaAPI):
 
 _APIs = [WikiSearchAPI, GoogleAPI, WolframAPI]
 REGISTERED_API = {_api.api_name: _api for _api in _APIs}
+for _api in _APIs:
+    _api.circuit_breaker = CircuitBreaker()
 
 
-def query_web_api(api_name: str, query: str, num_results: Optional[int] = None, **kwargs) -> List[str]:
+def call_web_api(api_name: str, query: str, num_results: Optional[int] = None, **kwargs) -> List[str]:
+    """ Call an API without going through its circuit breaker, the caller records the outcome. """
     API = REGISTERED_API.get(api_name, None)
     if API is None:
         raise KeyError(f"No such api_name: {api_name}")
     kwargs = {"query": query, **kwargs}
     if num_results is not None:
         kwargs["num_results"] = num_results
+    # A hung call must fail in time to be counted by the breaker
+    kwargs.setdefault("timeout", API.circuit_breaker.slow_call_time)
     return API.call(**kwargs)
 
 
-class GPT3API:
-    api_name = 'GPT3'
-    model_name = {
-        'tiny': 'text-ada-001',
-        'small': 'text-babbage-001',
-        'middle': 'text-curie-001',
-        'large': "text-davinci-003",
-    }
+def query_web_api(api_name: str, query: str, num_results: Optional[int] = None, **kwargs) -> List[str]:
+    API = REGISTERED_API.get(api_name, None)
+    if API is None:
+        raise KeyError(f"No such api_name: {api_name}")
 
-    @staticmethod
-    def call(query: str, search_result, model_type='text-curie-001'):
-        if openai.api_key is None:
-            raise RuntimeError("Set openai.api_key first")
-
-        prefix = "Web search results:"
-        num_words = 100
-        suffix = f"instructions: Using the provided web search " \
-                 f"results, write a comprehensive and summarized reply to the given query in {num_words} words and in " \
-                 f"English. The reply should let ChatGPT understand easily and fastly."
-        if not search_result:
-            return ''
-        prompt = prefix + str(search_result) + suffix + "Query:" + query
-        # print(query)
-        # print(prompt)
-        res = openai.Completion.create(
-            model=model_type,
-            prompt=prompt,
-            temperature=0,
-            max_tokens=500
-        )
-
-        text = res.get('choices')[0].get("text").strip()
-        # all_texts = [c.get("text").strip() for c in res.get('choices')]
-        # print(all_texts)
-        # json_res = json.dumps(res, ensure_ascii=False)
-        # print(json_res)
-        return text
+    breaker = API.circuit_breaker
+    ticket = breaker.allow_request()
+    if ticket is None:
+        raise CircuitOpenError(f"Circuit open for api_name: {api_name}")
+
+    try:
+        results = call_web_api(api_name, query, num_results, **kwargs)
+    except Exception:
+        breaker.record(ticket, False, time.monotonic() - ticket.started)
+        raise
+    breaker.record(ticket, True, time.monotonic() - ticket.started)
+    return results